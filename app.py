@@ -1,4 +1,8 @@
+import datetime
+import io
+
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import numpy as np
@@ -6,11 +10,15 @@ import plotly.graph_objects as go
 import dash_table
 import pandas as pd
 
-from data_acquire import load_forecast_data
-from database import fetch_forecast_data_as_df
+from data_acquire import LOCATION, load_forecast_data, load_forecast_data_batch, process_location
+from database import COLLECTIONS, count_weather_records, fetch_forecast_data_as_df
+from export import EXPORT_FORMATS, RESUMABLE_FORMATS, export_chunks, parse_rows_range
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
 COLORS = ['rgb(67,67,67)', 'rgb(115,115,115)', 'rgb(49,130,189)', 'rgb(189,189,189)']
+HOURLY_FEATURES = ['tempC', 'tempF', 'precipMM', 'uvIndex']
+DAILY_FEATURES = ['tempC', 'tempF', 'sunHour', 'uvIndex']     # daily tempC/tempF are 'min ~ max', the max is shown
+COMPARE_SEARCH_LIMIT = 50    # city options sent per keystroke in the comparison dropdown
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', '/assets/style.css']
 
 # Define the dash app first
@@ -76,7 +84,7 @@ def display_date(date_time):
 
 #df_table = pd.read_csv('https://raw.githubusercontent.com/plotly/datasets/master/solar.csv') #Change city when available
 def weather_table():
-    df_static_daily_forecast = fetch_forecast_data_as_df()[0]
+    df_static_daily_forecast = fetch_forecast_data_as_df(LOCATION)[0]
     df_static_daily_forecast['datetime'] = df_static_daily_forecast['datetime'].apply(display_date)
     return html.Div(children=[
         dcc.Markdown('''New York Weather Forecast''', className='row',style={'paddingLeft': '50%'}),
@@ -98,10 +106,10 @@ def hourly_static_stacked_trend_graph(stack=False):
     Returns scatter line plot of related weather features.
     If `stack` is `True`, the 4 features are stacked together.
     """
-    df_static_hourly_forecast = fetch_forecast_data_as_df()[1]
+    df_static_hourly_forecast = fetch_forecast_data_as_df(LOCATION)[1]
     if df_static_hourly_forecast is None:
         return go.Figure()
-    sources = ['tempC', 'tempF', 'precipMM', 'uvIndex']
+    sources = HOURLY_FEATURES
     x = df_static_hourly_forecast['datetime']
     fig = go.Figure()
     for i, s in enumerate(sources):
@@ -163,6 +171,74 @@ def select_city():
         ])])
 
 
+location_labels = {process_location(city, state): '{}, {}'.format(city, state)
+                   for city, state in zip(df['city'], df['state_id'])}
+def compare_cities():
+    """Select several cities and compare their forecasts side by side"""
+    return html.Div(children=[
+        dcc.Markdown('''
+        # City Comparison
+        Select any number of cities to overlay their 24-hour forecasts and compare the following days
+        in a heat-map. Forecasts are fetched for all selected cities at once.
+        ''', className='eleven columns', style={'paddingLeft': '5%'}),
+        html.Div(children=[
+            dcc.Dropdown(
+                id='compare-cities-dropdown',
+                options=[],                     # filled by `set_compare_cities_options` while typing
+                value=[],
+                multi=True,
+                placeholder='Type to search cities'
+            )], style={'paddingLeft': '5%', 'width': '90%'}),
+        html.Div(children=[
+            html.Div(children=[
+                dcc.Markdown('''Hourly feature'''),
+                dcc.Dropdown(id='compare-hourly-feature',
+                             options=[{'label': i, 'value': i} for i in HOURLY_FEATURES],
+                             value=HOURLY_FEATURES[0], clearable=False)
+            ], style={'width': '300px', 'marginLeft': '5%', 'display': 'inline-block'}),
+            html.Div(children=[
+                dcc.Markdown('''Daily feature'''),
+                dcc.Dropdown(id='compare-daily-feature',
+                             options=[{'label': i, 'value': i} for i in DAILY_FEATURES],
+                             value=DAILY_FEATURES[0], clearable=False)
+            ], style={'width': '300px', 'marginLeft': '5%', 'display': 'inline-block'}),
+        ]),
+        dcc.Store(id='compare-forecast-store'),
+        dcc.Graph(id='compare-hourly-graph'),
+        dcc.Graph(id='compare-daily-heatmap'),
+    ], className='row')
+
+
+def compare_hourly_graph(df_hourly, feature):
+    """Overlays the hourly `feature` of every city in the long-format `df_hourly`"""
+    fig = go.Figure()
+    for city, df_city in df_hourly.groupby('city', sort=False):
+        fig.add_trace(go.Scatter(x=df_city['datetime'], y=pd.to_numeric(df_city[feature], errors='coerce'),
+                                 mode='lines', name=location_labels.get(city, city), line={'width': 2}))
+    fig.update_layout(template='plotly_dark',
+                      title='24-Hour Forecast Comparison: {}'.format(feature),
+                      plot_bgcolor='#23272c',
+                      paper_bgcolor='#23272c',
+                      xaxis_title='Date')
+    return fig
+
+
+def compare_daily_heatmap(df_daily, feature):
+    """Heat-map of the daily `feature` with one row per city in the long-format `df_daily`"""
+    cities = list(df_daily['city'].unique())
+    values = pd.to_numeric(df_daily[feature].astype(str).str.split('~').str[-1], errors='coerce')
+    z = df_daily.assign(value=values).pivot(index='city', columns='datetime', values='value').reindex(cities)
+    fig = go.Figure(go.Heatmap(z=z.values, x=[display_date(d) for d in pd.to_datetime(z.columns)],
+                               y=[location_labels.get(city, city) for city in cities],
+                               colorscale='RdBu', reversescale=feature in ('tempC', 'tempF')))
+    fig.update_layout(template='plotly_dark',
+                      title='Daily Forecast Comparison: {}'.format(feature),
+                      plot_bgcolor='#23272c',
+                      paper_bgcolor='#23272c',
+                      height=max(400, 30 * len(cities)))
+    return fig
+
+
 def enhance_des():
     """
     Returns enhancement description in markdown
@@ -254,6 +330,7 @@ def dynamic_layout():
         dcc.Graph(id='stacked-trend-graph', figure=hourly_static_stacked_trend_graph(True)),
         select_city(),
         weather_table_interactive(),
+        compare_cities(),
         enhance_des(),
         enhancement(),
         # dcc.Graph(id='trend-graph', figure=static_stacked_trend_graph(stack=False)),
@@ -287,6 +364,47 @@ def update_table(city):
     df_interactive_daily_forecast['datetime'] = df_interactive_daily_forecast['datetime'].apply(display_date)
     return df_interactive_daily_forecast.to_dict('records')
 
+@app.callback(
+    dash.dependencies.Output('compare-cities-dropdown', 'options'),
+    [dash.dependencies.Input('compare-cities-dropdown', 'search_value')],
+    [dash.dependencies.State('compare-cities-dropdown', 'value')])
+def set_compare_cities_options(search_value, selected):
+    """Sends only the cities starting with the typed text, plus the selected ones so they stay displayed"""
+    selected = selected or []
+    matches = []
+    if search_value:
+        prefix = search_value.lower()
+        matches = [k for k, v in location_labels.items()
+                   if v.lower().startswith(prefix) and k not in selected][:COMPARE_SEARCH_LIMIT]
+    return [{'label': location_labels.get(k, k), 'value': k} for k in selected + matches]
+
+@app.callback(
+    dash.dependencies.Output('compare-forecast-store', 'data'),
+    [dash.dependencies.Input('compare-cities-dropdown', 'value')])
+def update_compare_store(locations):
+    """Fetches the forecasts of all selected cities in one batch"""
+    if not locations:
+        return None
+    df_daily, df_hourly = load_forecast_data_batch(locations)
+    return {'daily': df_daily.to_json(orient='split', date_format='iso'),
+            'hourly': df_hourly.to_json(orient='split', date_format='iso')}
+
+@app.callback(
+    [dash.dependencies.Output('compare-hourly-graph', 'figure'),
+     dash.dependencies.Output('compare-daily-heatmap', 'figure')],
+    [dash.dependencies.Input('compare-forecast-store', 'data'),
+     dash.dependencies.Input('compare-hourly-feature', 'value'),
+     dash.dependencies.Input('compare-daily-feature', 'value')])
+def update_compare_graphs(data, hourly_feature, daily_feature):
+    """Renders the comparison from the stored batch, so switching features makes no new requests"""
+    if not data:
+        return go.Figure(), go.Figure()
+    df_daily = pd.read_json(io.StringIO(data['daily']), orient='split')
+    df_hourly = pd.read_json(io.StringIO(data['hourly']), orient='split')
+    if df_daily.empty or df_hourly.empty:
+        return go.Figure(), go.Figure()
+    return compare_hourly_graph(df_hourly, hourly_feature), compare_daily_heatmap(df_daily, daily_feature)
+
 @app.callback(
     dash.dependencies.Output('indicator-graphic', 'figure'),
     [dash.dependencies.Input('xaxis-column', 'value'),
@@ -318,5 +436,65 @@ def update_graph(xaxis_column_name, year_value):
         )
     }
 
+
+def parse_export_date(name):
+    """Parses query parameter `name` as yyyy-MM-dd, aborting with 400 if missing or malformed"""
+    try:
+        return datetime.datetime.strptime(flask.request.args[name], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        flask.abort(400, 'Query parameter `{}` must be a date in yyyy-MM-dd format'.format(name))
+
+
+@app.server.route('/export/<source>/<frequency>')
+def export_weather_data(source, frequency):
+    """
+    Streams `source` ('forecast' or 'history') `frequency` ('daily' or 'hourly') weather data, e.g.
+    `/export/history/hourly?city=new%2Byork,ny&start=2018-01-01&end=2019-12-31&format=ndjson`.
+    `format` is csv (default), ndjson or parquet. CSV and NDJSON are gzipped when the client accepts it.
+    An interrupted CSV or NDJSON download resumes with `Range: rows=<first row>-`; Parquet files are
+    always served whole. Responds 404 if no rows match.
+    """
+    if (source, frequency) not in COLLECTIONS:
+        flask.abort(404)
+    city = flask.request.args.get('city')
+    if not city:
+        flask.abort(400, 'Query parameter `city` is required')
+    start, end = parse_export_date('start'), parse_export_date('end')
+    if start > end:
+        flask.abort(400, 'Start date must not be later than end date!')
+    fmt = flask.request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        flask.abort(400, 'Query parameter `format` must be one of {}'.format(', '.join(EXPORT_FORMATS)))
+    total = count_weather_records(source, frequency, city, start, end)
+    if total == 0:
+        flask.abort(404, 'No {} {} weather data for {} between {} and {}'.format(source, frequency, city, start, end))
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    headers = {
+        'Content-Disposition': 'attachment; filename="{}_{}_{}_{}_{}.{}"'.format(
+            source, frequency, ''.join(c if c.isalnum() else '_' for c in city), start, end, extension),
+    }
+    status = 200
+    first_row = None
+    if fmt in RESUMABLE_FORMATS:
+        headers['Accept-Ranges'] = 'rows'
+        first_row = parse_rows_range(flask.request.headers.get('Range'))
+    if first_row is not None:
+        if first_row >= total:
+            return flask.Response(status=416, headers={'Content-Range': 'rows */{}'.format(total)})
+        headers['Content-Range'] = 'rows {}-{}/{}'.format(first_row, total - 1, total)
+        status = 206
+
+    # Parquet pages are already compressed
+    compress = False
+    if fmt != 'parquet':
+        headers['Vary'] = 'Accept-Encoding'
+        compress = flask.request.accept_encodings['gzip'] > 0
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    body = export_chunks(source, frequency, city, start, end, fmt, skip=first_row or 0, compress=compress)
+    return flask.Response(body, status=status, headers=headers, mimetype=mimetype)
+
+
 if __name__ == '__main__':
     app.run_server(debug=False, port=1050, host='0.0.0.0')
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+Throughput benchmark for the streaming export behind `/export/<source>/<frequency>`.
+
+Seeds synthetic hourly history for several cities and years into a scratch database, then times every
+format, with and without gzip, both by calling `export.export_chunks` directly and through the Flask
+route with `app.server.test_client()`. Peak Python memory is measured in a separate, untimed pass since
+`tracemalloc` slows allocation down considerably. Requires a running `mongod`:
+
+    python3 benchmark_export.py --cities 10 --years 3
+"""
+import argparse
+import datetime
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import database
+from app import app
+from export import EXPORT_FORMATS, export_chunks
+
+BENCHMARK_DB_NAME = 'weather_benchmark'
+START = datetime.date(2016, 1, 1)
+
+
+def seed_hourly_history(cities, years):
+    """Inserts `years` of synthetic hourly history per city; returns the last date covered"""
+    database.ensure_indexes()
+    collection = database.client.get_database(BENCHMARK_DB_NAME).get_collection(
+        database.COLLECTIONS['history', 'hourly'])
+    end = START + datetime.timedelta(days=365 * years - 1)
+    datetimes = pd.date_range(START, periods=365 * years * 24, freq='h')
+    rng = np.random.default_rng(0)
+    for city in cities:
+        df = pd.DataFrame({'city': city, 'datetime': datetimes})
+        df['tempC'] = rng.integers(-10, 35, len(df)).astype(str)
+        df['tempF'] = rng.integers(14, 95, len(df)).astype(str)
+        df['windspeedKmph'] = rng.integers(0, 40, len(df)).astype(str)
+        df['weatherDesc'] = 'Partly cloudy'
+        df['precipMM'] = rng.random(len(df)).round(1).astype(str)
+        df['humidity'] = rng.integers(20, 100, len(df)).astype(str)
+        df['uvIndex'] = rng.integers(1, 9, len(df)).astype(str)
+        for chunk in range(0, len(df), database.EXPORT_BATCH_SIZE):
+            collection.insert_many(df.iloc[chunk:chunk + database.EXPORT_BATCH_SIZE].to_dict('records'))
+    return end
+
+
+def export_direct(city, end, fmt, compress):
+    return export_chunks('history', 'hourly', city, START, end, fmt, compress=compress)
+
+
+def export_http(client, city, end, fmt, compress):
+    headers = {'Accept-Encoding': 'gzip'} if compress else {}
+    response = client.get('/export/history/hourly', headers=headers, buffered=False,
+                          query_string={'city': city, 'start': str(START), 'end': str(end), 'format': fmt})
+    try:
+        for chunk in response.iter_encoded():
+            yield chunk
+    finally:
+        response.close()
+
+
+def exported_size(export, cities, end, fmt, compress):
+    """Consumes the export of every city and returns the number of bytes produced"""
+    return sum(len(chunk) for city in cities for chunk in export(city, end, fmt, compress))
+
+
+def run(cities, end, formats):
+    client = app.server.test_client()
+    paths = (('direct', export_direct), ('http', lambda *args: export_http(client, *args)))
+    rows = sum(database.count_weather_records('history', 'hourly', city, START, end) for city in cities)
+    print('{:<8} {:<5} {:<7} {:>10} {:>10} {:>12} {:>10} {:>10}'.format(
+        'format', 'gzip', 'path', 'rows', 'MB out', 'rows/s', 'MB/s', 'peak MB'))
+    for fmt in formats:
+        for compress in (False, True):
+            if fmt == 'parquet' and compress:
+                continue
+            tracemalloc.start()
+            exported_size(export_direct, cities, end, fmt, compress)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            for path, export in paths:
+                tic = time.perf_counter()
+                size = exported_size(export, cities, end, fmt, compress)
+                elapsed = time.perf_counter() - tic
+                print('{:<8} {:<5} {:<7} {:>10} {:>10.1f} {:>12.0f} {:>10.1f} {:>10.1f}'.format(
+                    fmt, str(compress), path, rows, size / 2**20, rows / elapsed, size / 2**20 / elapsed,
+                    peak / 2**20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cities', type=int, default=5, help='number of synthetic cities')
+    parser.add_argument('--years', type=int, default=2, help='years of hourly history per city')
+    parser.add_argument('--formats', nargs='+', default=list(EXPORT_FORMATS), choices=list(EXPORT_FORMATS))
+    parser.add_argument('--keep', action='store_true', help='keep the scratch database afterwards')
+    args = parser.parse_args()
+
+    database.DB_NAME = BENCHMARK_DB_NAME
+    database.client.drop_database(BENCHMARK_DB_NAME)
+    city_names = ['city{:03d}'.format(i) for i in range(args.cities)]
+    try:
+        run(city_names, seed_hourly_history(city_names, args.years), args.formats)
+    finally:
+        if not args.keep:
+            database.client.drop_database(BENCHMARK_DB_NAME)
@@ -1,13 +1,15 @@
 import pandas as pd
+import argparse
 import logging
 import requests
 import datetime
 import string
 import time
 import sched
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
-from database import upsert_forecast_data
+from database import ensure_indexes, fetch_fresh_forecast_data_as_df, upsert_forecast_data, upsert_historical_data
 
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'data.log')
@@ -15,6 +17,10 @@ utils.setup_logger(logger, 'data.log')
 
 LOCATION = 'New+York'
 DOWNLOAD_PERIOD = 15         # second
+FORECAST_MAX_AGE = 30 * 60   # second, stored forecasts younger than this are served without an API call
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = 10         # second, per connect/read so a stalled city fails instead of hanging a batch
+HISTORY_CHUNK_DAYS = 30      # days of history downloaded per upsert
 
 
 def process_location(city, state):
@@ -71,7 +77,7 @@ def load_historical_data(location, dates):
         paras['date'] = day
         paras['tp'] = interval
         
-        r = requests.get(url, paras)
+        r = requests.get(url, paras, timeout=REQUEST_TIMEOUT)
         r.raise_for_status()                             ### try and except? ### 
 
         city = r.json()['data']['request'][0]['query']
@@ -159,7 +165,7 @@ def load_forecast_data(location, num_of_days=7, num_of_hours=24):
     paras['show_comments'] = show_comments
     paras['showlocaltime'] = show_local_time
 
-    res = requests.get(url, paras)
+    res = requests.get(url, paras, timeout=REQUEST_TIMEOUT)
     res.raise_for_status()
 
     res_hourly_data = []
@@ -229,9 +235,91 @@ def load_forecast_data(location, num_of_days=7, num_of_hours=24):
     return df_daily_forecast, df_hourly_forecast
 
 
-def update_forecast_once():
-    df_daily_forecast, df_hourly_forecast = load_forecast_data(LOCATION)
+def update_forecast_once(location=LOCATION):
+    '''
+    Downloads the forecast of `location` and stores it tagged with `city` and `fetched_at` (UTC)
+    return: df_daily_forecast
+            df_hourly_forecast
+    '''
+    df_daily_forecast, df_hourly_forecast = load_forecast_data(location)
+    fetched_at = datetime.datetime.utcnow()
+    for df in (df_daily_forecast, df_hourly_forecast):
+        df.insert(0, 'city', location)
+        df['fetched_at'] = fetched_at
     upsert_forecast_data(df_daily_forecast, df_hourly_forecast)
+    return df_daily_forecast, df_hourly_forecast
+
+
+def load_forecast_data_batch(locations, max_age=FORECAST_MAX_AGE, max_workers=MAX_CONCURRENT_REQUESTS):
+    '''
+    locations: list of locations, e.g. from `process_location`
+    max_age: seconds a stored forecast stays fresh
+    return: df_daily_forecast
+            df_hourly_forecast
+    Both are long format: the per-city frames of `load_forecast_data` stacked with `city` and
+    `fetched_at` columns. Fresh forecasts are read from the database; the remaining locations are
+    downloaded concurrently and stored. Locations whose download fails are logged and left out.
+    '''
+    locations = list(dict.fromkeys(locations))          # de-duplicate, keep order
+    df_daily_stored, df_hourly_stored = fetch_fresh_forecast_data_as_df(locations, max_age)
+    stored = set(df_daily_stored['city']) if not df_daily_stored.empty else set()
+    misses = [location for location in locations if location not in stored]
+
+    def _worker(location):
+        try:
+            return update_forecast_once(location)
+        except Exception as e:
+            logger.warning("batch forecast skips {}: {}".format(location, e))
+            return None
+
+    daily_frames, hourly_frames = [df_daily_stored], [df_hourly_stored]
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(misses))) as executor:
+            for result in executor.map(_worker, misses):
+                if result is not None:
+                    daily_frames.append(result[0])
+                    hourly_frames.append(result[1])
+    logger.info("Batch forecast: {} cities, {} from db, {} downloaded".format(
+        len(locations), len(stored), len(daily_frames) - 1))
+
+    order = {location: i for i, location in enumerate(locations)}
+    ret = []
+    for frames in (daily_frames, hourly_frames):
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            ret.append(pd.DataFrame())
+            continue
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        df = df.assign(_order=df['city'].map(order)).sort_values(['_order', 'datetime'], kind='stable')
+        ret.append(df.drop(columns='_order').reset_index(drop=True))
+    return ret[0], ret[1]
+
+
+def update_historical_once(location, dates):
+    '''
+    location: query string, e.g. from `process_location`
+    dates: list of date --- yyyy-MM-dd, e.g. from `process_date_historical`
+    '''
+    df_day, df_hourly = load_historical_data(location, dates)
+    df_day['city'] = location           # key history by the query string, like forecasts
+    df_hourly['city'] = location
+    upsert_historical_data(df_day, df_hourly)
+
+
+def backfill_historical_data(city, state, start_date, end_date):
+    '''
+    city, state: e.g. 'New York', 'NY'; stored under `process_location(city, state)`
+    start_date, end_date: yyyy-MM-dd, inclusive
+    History is stored every `HISTORY_CHUNK_DAYS` days, so an interrupted backfill keeps what it fetched.
+    '''
+    location = process_location(city, state)
+    start, end = pd.to_datetime(start_date, format='%Y-%m-%d'), pd.to_datetime(end_date, format='%Y-%m-%d')
+    if start > end:
+        raise ValueError ('Start date must not be later than end date!')
+    dates = list(pd.date_range(start, end, freq='D').strftime('%Y-%m-%d'))
+    for i in range(0, len(dates), HISTORY_CHUNK_DAYS):
+        update_historical_once(location, dates[i:i + HISTORY_CHUNK_DAYS])
+        logger.info("Backfill {}: {} of {} days stored".format(location, min(i + HISTORY_CHUNK_DAYS, len(dates)), len(dates)))
 
 
 def main_loop(timeout=DOWNLOAD_PERIOD):
@@ -248,5 +336,13 @@ def main_loop(timeout=DOWNLOAD_PERIOD):
     scheduler.run(blocking=True)
 
 if __name__ == '__main__':
-    main_loop()
+    parser = argparse.ArgumentParser(description='Keeps the forecast of {} up to date, or backfills history'.format(LOCATION))
+    parser.add_argument('--backfill', nargs=4, metavar=('CITY', 'STATE', 'START', 'END'),
+                        help="store history of a city between two yyyy-MM-dd dates, e.g. 'New York' NY 2019-01-01 2019-12-31")
+    args = parser.parse_args()
+    ensure_indexes()
+    if args.backfill:
+        backfill_historical_data(*args.backfill)
+    else:
+        main_loop()
 
@@ -1,3 +1,4 @@
+import datetime
 import logging
 import pymongo
 import pandas as pd
@@ -9,20 +10,42 @@ client = pymongo.MongoClient()
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'database.log')
 RESULT_CACHE_EXPIRATION = 15             # seconds
+EXPORT_BATCH_SIZE = 5000                 # documents per cursor round trip
+DB_NAME = 'weather'
+
+# (source, frequency) -> collection name
+COLLECTIONS = {
+    ('forecast', 'daily'): 'daily_weather_forecast',
+    ('forecast', 'hourly'): 'hourly_weather_forecast',
+    ('history', 'daily'): 'daily_weather_history',
+    ('history', 'hourly'): 'hourly_weather_history',
+}
+
+def ensure_indexes():
+    """
+    Creates the unique (`city`, `datetime`) index every collection is keyed and exported by. Documents
+    stored before forecasts carried a `city` are left out of the index. Call once per process.
+    """
+    db = client.get_database(DB_NAME)
+    for name in COLLECTIONS.values():
+        db.get_collection(name).create_index([('city', pymongo.ASCENDING), ('datetime', pymongo.ASCENDING)],
+                                             unique=True, partialFilterExpression={'city': {'$exists': True}})
+
 
 def upsert_forecast_data(df_daily_forecast, df_hourly_forecast):
     """
     Update MongoDB database `daily_forecast`,  and collection `daily_forecast` with the given `df_daily_forecast`
     Update MongoDB database `hourly_forecast`,  and collection `hourly_forecast` with the given `df_hourly_forecast`
+    Both data frames carry a `city` column; documents are keyed by (`city`, `datetime`).
     """
-    db = client.get_database("weather")
-    collection_daily = db.get_collection("daily_weather_forecast")
-    collection_hourly = db.get_collection("hourly_weather_forecast")
+    db = client.get_database(DB_NAME)
+    collection_daily = db.get_collection(COLLECTIONS['forecast', 'daily'])
+    collection_hourly = db.get_collection(COLLECTIONS['forecast', 'hourly'])
 
     update_count_daily = 0
     for record in df_daily_forecast.to_dict('records'):
         result = collection_daily.replace_one(
-            filter={'datetime': record['datetime']},    # locate the document if exists
+            filter={'city': record['city'], 'datetime': record['datetime']},    # locate the document if exists
             replacement=record,                         # latest document
             upsert=True)                                # update if exists, insert if not
         if result.matched_count > 0:
@@ -32,30 +55,92 @@ def upsert_forecast_data(df_daily_forecast, df_hourly_forecast):
 
     update_count_hourly = 0
     for record in df_hourly_forecast.to_dict('records'):
-        result1 = collection_hourly.replace_one(
-            filter={'datetime': record['datetime']},    # locate the document if exists
+        deleted_count = 0
+        if record['current']:
+            # keep one current document per city: drop the previous one once local time has moved on
+            deleted_count = collection_hourly.delete_many(
+                filter={'city': record['city'], 'current': True, 'datetime': {'$ne': record['datetime']}}).deleted_count
+        result = collection_hourly.replace_one(
+            filter={'city': record['city'], 'datetime': record['datetime']},    # locate the document if exists
             replacement=record,                         # latest document
             upsert=True)                                # update if exists, insert if not
-        if result1.matched_count > 0:
+        if result.matched_count > 0 or deleted_count > 0:
             update_count_hourly += 1
-
-        if record['current']:
-            result2 = collection_hourly.replace_one(
-                filter={'current': True},                    # locate the document if exists
-                replacement=record,                         # latest document
-                upsert=True)                                # update if exists, insert if not
-            if result2.matched_count > 0 and result1.matched_count <= 0:
-                update_count_hourly += 1
     logger.info("Hourly forecast weather: rows={}, update={}, ".format(df_hourly_forecast.shape[0], update_count_hourly) +
                 "insert={}".format(df_hourly_forecast.shape[0]-update_count_hourly))
 
 
-def fetch_forecast_data():
-    db = client.get_database("weather")
-    collection_daily = db.get_collection("daily_weather_forecast")
-    collection_hourly = db.get_collection("hourly_weather_forecast")
-    ret_daily = list(collection_daily.find())
-    ret_hourly = list(collection_hourly.find())
+def upsert_historical_data(df_daily, df_hourly):
+    """
+    Update MongoDB collections `daily_weather_history` and `hourly_weather_history` with the data frames
+    returned by `data_acquire.load_historical_data`. Documents are keyed by (`city`, `datetime`).
+    """
+    db = client.get_database(DB_NAME)
+    for frequency, df in (('daily', df_daily), ('hourly', df_hourly)):
+        collection = db.get_collection(COLLECTIONS['history', frequency])
+        update_count = 0
+        for record in df.to_dict('records'):
+            result = collection.replace_one(
+                filter={'city': record['city'], 'datetime': record['datetime']},
+                replacement=record,
+                upsert=True)
+            if result.matched_count > 0:
+                update_count += 1
+        logger.info("{} historical weather: rows={}, update={}, ".format(frequency.capitalize(), df.shape[0], update_count) +
+                    "insert={}".format(df.shape[0]-update_count))
+
+
+def _export_filter(city, start, end):
+    """Mongo filter for `city` with `datetime` in the closed date range [`start`, `end`]"""
+    return {'city': city,
+            'datetime': {'$gte': datetime.datetime.combine(start, datetime.time()),
+                         '$lt': datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time())}}
+
+
+def count_weather_records(source, frequency, city, start, end):
+    """
+    Number of documents `iter_weather_records` yields for the same arguments (without `skip`). Uses the
+    same filter, but is only a snapshot: documents upserted in between change the export.
+    """
+    collection = client.get_database(DB_NAME).get_collection(COLLECTIONS[source, frequency])
+    return collection.count_documents(_export_filter(city, start, end))
+
+
+def iter_weather_records(source, frequency, city, start, end, skip=0, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields lists of at most `batch_size` documents (without `_id`) of `city` between dates `start` and
+    `end` inclusive, ordered by `datetime`, which the unique (`city`, `datetime`) index makes stable
+    across calls. `source` is 'forecast' or 'history', `frequency` is 'daily' or 'hourly'. Only one
+    batch is held in memory at a time; `skip` drops leading documents so an interrupted export can
+    resume.
+    """
+    collection = client.get_database(DB_NAME).get_collection(COLLECTIONS[source, frequency])
+    cursor = collection.find(_export_filter(city, start, end), projection={'_id': False},
+                             sort=[('datetime', pymongo.ASCENDING)], skip=skip, batch_size=batch_size)
+    count = 0
+    batch = []
+    try:
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == batch_size:
+                count += len(batch)
+                yield batch
+                batch = []
+        if batch:
+            count += len(batch)
+            yield batch
+    finally:
+        cursor.close()
+    logger.info('{} {} weather: {} documents exported for {}'.format(source, frequency, count, city))
+
+
+def fetch_forecast_data(city=None):
+    db = client.get_database(DB_NAME)
+    collection_daily = db.get_collection(COLLECTIONS['forecast', 'daily'])
+    collection_hourly = db.get_collection(COLLECTIONS['forecast', 'hourly'])
+    query = {} if city is None else {'city': city}
+    ret_daily = list(collection_daily.find(query))
+    ret_hourly = list(collection_hourly.find(query))
     logger.info('Daily weather: ' + str(len(ret_daily)) + ' documents read from the db')
     logger.info('Hourly weather: ' + str(len(ret_hourly)) + ' documents read from the db')
     return ret_daily, ret_hourly
@@ -64,33 +149,60 @@ _fetch_forecast_data_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
 
-def fetch_forecast_data_as_df(allow_cached=False):
+def fetch_forecast_data_as_df(city=None, allow_cached=False):
     """Converts list of dicts returned by `fetch_all_bpa` to DataFrame with ID removed
     Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
     `_fetch_all_bpa_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
+    is False. `city` restricts the result to one city; `None` returns every stored document.
     """
     def _work():
-        daily_forecast_data, hourly_forecast_data = fetch_forecast_data()
+        daily_forecast_data, hourly_forecast_data = fetch_forecast_data(city)
         if len(daily_forecast_data) == 0 or len(hourly_forecast_data) == 0:
             return None
         df_daily_forecast = pd.DataFrame.from_records(daily_forecast_data)
-        df_daily_forecast.drop('_id', axis=1, inplace=True)
+        df_daily_forecast.drop(['_id', 'city', 'fetched_at'], axis=1, inplace=True, errors='ignore')
 
         df_hourly_forecast = pd.DataFrame.from_records(hourly_forecast_data)
-        df_hourly_forecast.drop('_id', axis=1, inplace=True)
+        df_hourly_forecast.drop(['_id', 'city', 'fetched_at'], axis=1, inplace=True, errors='ignore')
 
         return (df_daily_forecast, df_hourly_forecast)
 
     if allow_cached:
         try:
-            return _fetch_forecast_data_as_df_cache['cache']
+            return _fetch_forecast_data_as_df_cache[city]
         except KeyError:
             pass
     ret = _work()
-    _fetch_forecast_data_as_df_cache['cache'] = ret
+    _fetch_forecast_data_as_df_cache[city] = ret
     return ret
 
+
+def fetch_fresh_forecast_data_as_df(cities, max_age_seconds):
+    """
+    Returns `(df_daily_forecast, df_hourly_forecast)` in long format, i.e. stacked with a `city` column,
+    holding the latest stored forecast of each of `cities` fetched within the last `max_age_seconds`.
+    A city is only included if both its daily and hourly forecasts are fresh; both frames are empty
+    if none is.
+    """
+    db = client.get_database(DB_NAME)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age_seconds)
+    query = {'city': {'$in': list(cities)}, 'fetched_at': {'$gte': cutoff}}
+    frames = []
+    for frequency in ('daily', 'hourly'):
+        collection = db.get_collection(COLLECTIONS['forecast', frequency])
+        df = pd.DataFrame.from_records(list(collection.find(query, projection={'_id': False})))
+        if df.empty:
+            return pd.DataFrame(), pd.DataFrame()
+        # rows left over from an earlier fetch within the window are superseded by the latest one
+        df = df[df['fetched_at'] == df.groupby('city')['fetched_at'].transform('max')]
+        df = df.drop_duplicates(['city', 'datetime'], keep='last')
+        frames.append(df)
+    df_daily_forecast, df_hourly_forecast = frames
+    fresh = set(df_daily_forecast['city']) & set(df_hourly_forecast['city'])
+    logger.info('Forecast weather: {} of {} cities fresh in the db'.format(len(fresh), len(set(cities))))
+    return (df_daily_forecast[df_daily_forecast['city'].isin(fresh)].reset_index(drop=True),
+            df_hourly_forecast[df_hourly_forecast['city'].isin(fresh)].reset_index(drop=True))
+
 if __name__ == '__main__':
     print(fetch_forecast_data_as_df()[0])
     print('--------------------')
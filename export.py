@@ -0,0 +1,127 @@
+import io
+import re
+import zlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database import iter_weather_records
+
+RESUMABLE_FORMATS = ('csv', 'ndjson')
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+GZIP_LEVEL = 6
+ROWS_RANGE = re.compile(r'^rows=(\d+)-$')
+
+
+def parse_rows_range(header):
+    """
+    Returns the first row requested by a `Range: rows=<first>-` header, or `None` if the header is
+    missing or uses another unit (e.g. bytes), in which case the full export should be served.
+    """
+    match = ROWS_RANGE.match((header or '').strip())
+    return int(match.group(1)) if match else None
+
+
+def _frames(batches):
+    """Converts document batches to DataFrames, keeping the column order of the first batch"""
+    columns = None
+    for batch in batches:
+        df = pd.DataFrame.from_records(batch)
+        if columns is None:
+            columns = list(df.columns)
+        yield df.reindex(columns=columns)
+
+
+def _csv_chunks(frames, header=True):
+    for df in frames:
+        yield df.to_csv(index=False, header=header, date_format='%Y-%m-%d %H:%M:%S').encode('utf-8')
+        header = False
+
+
+def _ndjson_chunks(frames, header=True):
+    for df in frames:
+        text = df.to_json(orient='records', lines=True, date_format='iso')
+        if not text.endswith('\n'):
+            text += '\n'
+        yield text.encode('utf-8')
+
+
+class _ParquetSink(io.RawIOBase):
+    """Write-only file handing out what the Parquet writer has produced so far via `drain`"""
+    def __init__(self):
+        super().__init__()
+        self._pending = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._pending += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = bytes(self._pending)
+        self._pending.clear()
+        return data
+
+
+def _parquet_chunks(frames, header=True):
+    """
+    One row group per batch; the footer is written when the last batch has been consumed. Every call
+    produces a complete file, so Parquet exports cannot be resumed.
+    """
+    sink = _ParquetSink()
+    writer = None
+    for df in frames:
+        if writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            writer = pq.ParquetWriter(sink, table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+_WRITERS = {
+    'csv': _csv_chunks,
+    'ndjson': _ndjson_chunks,
+    'parquet': _parquet_chunks,
+}
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compresses a stream of byte chunks into a single gzip member without buffering the whole body"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(source, frequency, city, start, end, fmt, skip=0, compress=False):
+    """
+    Yields the encoded export of `city` between dates `start` and `end` inclusive as byte chunks.
+    Documents are streamed from MongoDB one batch at a time, so memory stays constant in the size
+    of the range. `skip` resumes an interrupted CSV or NDJSON export at that row (the CSV header is
+    left out, as the client already has it); `compress` gzips the stream.
+    """
+    batches = iter_weather_records(source, frequency, city, start, end, skip=skip)
+    chunks = _WRITERS[fmt](_frames(batches), header=skip == 0)
+    chunks = (chunk for chunk in chunks if chunk)
+    return gzip_chunks(chunks) if compress else chunks
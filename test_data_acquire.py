@@ -0,0 +1,75 @@
+import datetime
+
+import pandas as pd
+
+import data_acquire
+
+FETCHED_AT = datetime.datetime(2019, 12, 6, 12, 0)
+
+
+def forecast(city, days=2, hours=3):
+    """Daily and hourly frames shaped like `update_forecast_once` output, hourly rows in reverse order"""
+    df_daily = pd.DataFrame({'city': city,
+                             'datetime': pd.date_range('2019-12-06', periods=days, freq='D'),
+                             'tempC': '1 ~ 5',
+                             'fetched_at': FETCHED_AT})
+    df_hourly = pd.DataFrame({'city': city,
+                              'current': [False] * (hours - 1) + [True],
+                              'datetime': pd.date_range('2019-12-06 12:00', periods=hours, freq='h')[::-1],
+                              'tempC': '3',
+                              'fetched_at': FETCHED_AT})
+    return df_daily, df_hourly
+
+
+def patch_sources(monkeypatch, stored, failing=()):
+    downloaded = []
+
+    def _fetch_fresh(cities, max_age_seconds):
+        frames = [forecast(city) for city in cities if city in stored]
+        if not frames:
+            return pd.DataFrame(), pd.DataFrame()
+        return (pd.concat([f[0] for f in frames], ignore_index=True),
+                pd.concat([f[1] for f in frames], ignore_index=True))
+
+    def _update(location):
+        downloaded.append(location)
+        if location in failing:
+            raise ValueError('upstream error')
+        return forecast(location)
+    monkeypatch.setattr(data_acquire, 'fetch_fresh_forecast_data_as_df', _fetch_fresh)
+    monkeypatch.setattr(data_acquire, 'update_forecast_once', _update)
+    return downloaded
+
+
+def test_load_forecast_data_batch_merges_stored_and_downloaded(monkeypatch):
+    downloaded = patch_sources(monkeypatch, stored={'boston,ma'})
+    df_daily, df_hourly = data_acquire.load_forecast_data_batch(['providence,ri', 'boston,ma', 'austin,tx',
+                                                                 'providence,ri'])
+    assert sorted(downloaded) == ['austin,tx', 'providence,ri']
+    assert list(df_daily['city'].unique()) == ['providence,ri', 'boston,ma', 'austin,tx']
+    assert df_daily.shape[0] == 6
+    assert df_hourly.shape[0] == 9
+    for _, df_city in df_hourly.groupby('city'):
+        assert df_city['datetime'].is_monotonic_increasing
+    assert list(df_hourly.index) == list(range(9))
+
+
+def test_load_forecast_data_batch_skips_failed_city(monkeypatch):
+    downloaded = patch_sources(monkeypatch, stored={'boston,ma'}, failing={'austin,tx'})
+    df_daily, df_hourly = data_acquire.load_forecast_data_batch(['austin,tx', 'boston,ma', 'providence,ri'])
+    assert sorted(downloaded) == ['austin,tx', 'providence,ri']
+    assert list(df_daily['city'].unique()) == ['boston,ma', 'providence,ri']
+    assert list(df_hourly['city'].unique()) == ['boston,ma', 'providence,ri']
+
+
+def test_load_forecast_data_batch_all_stored(monkeypatch):
+    downloaded = patch_sources(monkeypatch, stored={'boston,ma'})
+    df_daily, df_hourly = data_acquire.load_forecast_data_batch(['boston,ma'])
+    assert downloaded == []
+    assert df_daily.shape[0] == 2 and df_hourly.shape[0] == 3
+
+
+def test_load_forecast_data_batch_all_failed(monkeypatch):
+    patch_sources(monkeypatch, stored=set(), failing={'austin,tx'})
+    df_daily, df_hourly = data_acquire.load_forecast_data_batch(['austin,tx'])
+    assert df_daily.empty and df_hourly.empty
@@ -0,0 +1,79 @@
+import datetime
+import gzip
+import io
+
+import pyarrow.parquet as pq
+import pandas as pd
+
+import export
+
+CITY = 'providence'
+START, END = datetime.date(2019, 1, 1), datetime.date(2019, 1, 2)
+
+
+def make_batches(sizes, start=0):
+    """Batches of hourly documents shaped like `database.iter_weather_records` output"""
+    batches, i = [], start
+    for size in sizes:
+        batches.append([{'city': CITY,
+                         'datetime': datetime.datetime(2019, 1, 1) + datetime.timedelta(hours=i + j),
+                         'tempC': str(i + j)} for j in range(size)])
+        i += size
+    return batches
+
+
+def patch_records(monkeypatch, sizes):
+    calls = []
+
+    def _iter_weather_records(source, frequency, city, start, end, skip=0):
+        calls.append(skip)
+        return iter(make_batches(sizes, start=skip))
+    monkeypatch.setattr(export, 'iter_weather_records', _iter_weather_records)
+    return calls
+
+
+def test_parse_rows_range():
+    assert export.parse_rows_range('rows=10-') == 10
+    assert export.parse_rows_range(' rows=0- ') == 0
+    assert export.parse_rows_range('bytes=0-100') is None
+    assert export.parse_rows_range('rows=1-5') is None
+    assert export.parse_rows_range(None) is None
+
+
+def test_gzip_chunks_round_trip():
+    chunks = [b'a,b\n', b'1,2\n' * 1000, b'3,4\n']
+    assert gzip.decompress(b''.join(export.gzip_chunks(iter(chunks)))) == b''.join(chunks)
+
+
+def test_export_chunks_csv(monkeypatch):
+    patch_records(monkeypatch, [2, 2])
+    text = b''.join(export.export_chunks('history', 'hourly', CITY, START, END, 'csv')).decode()
+    lines = text.splitlines()
+    assert lines[0] == 'city,datetime,tempC'
+    assert len(lines) == 5
+    assert lines[1] == 'providence,2019-01-01 00:00:00,0'
+
+
+def test_export_chunks_csv_resume_has_no_header(monkeypatch):
+    calls = patch_records(monkeypatch, [2, 1])
+    chunks = export.export_chunks('history', 'hourly', CITY, START, END, 'csv', skip=3, compress=True)
+    lines = gzip.decompress(b''.join(chunks)).decode().splitlines()
+    assert calls == [3]
+    assert len(lines) == 3
+    assert lines[0].startswith('providence,2019-01-01 03:00:00')
+
+
+def test_export_chunks_ndjson(monkeypatch):
+    patch_records(monkeypatch, [2, 3])
+    text = b''.join(export.export_chunks('history', 'hourly', CITY, START, END, 'ndjson')).decode()
+    df = pd.read_json(io.StringIO(text), lines=True)
+    assert list(df['tempC']) == [0, 1, 2, 3, 4]
+
+
+def test_parquet_chunks_row_groups():
+    frames = (pd.DataFrame.from_records(batch) for batch in make_batches([3, 3, 2]))
+    data = b''.join(export._parquet_chunks(frames))
+    assert pq.ParquetFile(io.BytesIO(data)).num_row_groups == 3
+    table = pq.read_table(io.BytesIO(data))
+    assert table.num_rows == 8
+    assert table.column('tempC').to_pylist() == [str(i) for i in range(8)]